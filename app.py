@@ -1,154 +1,250 @@
-from flask import Flask, request, send_file, render_template_string
+from quart import Quart, Response, request
 from werkzeug.utils import secure_filename
 import os
 import zipfile
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+import soupsieve
 import tempfile
 import aiohttp
 import asyncio
+import cachetools
+import codecs
+import gzip
 import logging
-from urllib.parse import urljoin
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urldefrag, urljoin
 
-app = Flask(__name__)
+app = Quart(__name__)
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 
-# Temporary directory to store uploaded files
+# Scratch directory for uploaded files, created once per process
 UPLOAD_FOLDER = tempfile.mkdtemp()
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Saved-site archives can be large and slow to upload; Quart defaults to a
+# 16 MB body limit and a 60 second body timeout, Flask had no limit at all
+app.config['MAX_CONTENT_LENGTH'] = None
+app.config['BODY_TIMEOUT'] = 300  # 5 minutes to receive an upload
+
 # Constants for HTTP requests
 HTTP_TIMEOUT = 10  # 10 seconds timeout for HTTP requests
+MAX_CONCURRENT_FETCHES = 20  # Asset downloads in flight per page
+
+# Combined documents for recently requested URLs, keyed by normalized URL;
+# the size budget counts bytes of cached HTML, not entries
+COMBINED_CACHE_BYTES = 64 * 1024 * 1024  # 64 MB
+COMBINED_CACHE_TTL = 300  # 5 minutes
+combined_cache = cachetools.TTLCache(maxsize=COMBINED_CACHE_BYTES, ttl=COMBINED_CACHE_TTL, getsizeof=len)
+
+# Parse only these tags when collecting asset URLs from a remote page
+ASSET_STRAINER = SoupStrainer(['link', 'script'])
+
+# Selectors for assets to inline, compiled once and reused for every page
+STYLESHEET_SELECTOR = soupsieve.compile('link[rel~="stylesheet"][href]')
+SCRIPT_SELECTOR = soupsieve.compile('script[src]')
+
+# Any mention of an @import at-rule (at-rule names are case-insensitive)
+CSS_IMPORT_RE = re.compile(r'@import', re.IGNORECASE)
+
+# Thread pool size for reading ZIP asset entries concurrently
+FILE_READ_WORKERS = 8
+
+def get_http_session():
+    # Must be called from a coroutine running on the server's event loop
+    session = app.extensions.get('http_session')
+    if session is None:
+        # AsyncResolver (aiodns) resolves on the event loop instead of the
+        # default threadpool getaddrinfo
+        connector = aiohttp.TCPConnector(resolver=aiohttp.AsyncResolver(), limit=100, limit_per_host=20, ttl_dns_cache=300)
+        session = aiohttp.ClientSession(connector=connector)
+        app.extensions['http_session'] = session
+    return session
+
+@app.after_serving
+async def close_http_session():
+    session = app.extensions.pop('http_session', None)
+    if session is not None:
+        await session.close()
+
+def get_file_read_executor():
+    # Like the HTTP session, created on first use and dropped on shutdown so
+    # a later serving cycle gets a fresh pool
+    executor = app.extensions.get('file_read_executor')
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=FILE_READ_WORKERS)
+        app.extensions['file_read_executor'] = executor
+    return executor
+
+@app.after_serving
+async def close_file_read_executor():
+    executor = app.extensions.pop('file_read_executor', None)
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+def encode_soup(soup):
+    # 'minimal' only escapes &, < and >, which is the least work that still
+    # produces valid HTML; formatter=None would emit decoded entities raw
+    return soup.encode('utf-8', formatter='minimal')
+
+def group_css(css_contents):
+    # Browsers ignore @import after any other rule, so a file that may contain
+    # one starts a new stylesheet; files without imports are appended to the
+    # current one. Matching is deliberately loose (comments and strings count)
+    # since a false positive only costs an extra <style> tag
+    groups = []
+    for css in css_contents:
+        if not groups or CSS_IMPORT_RE.search(css):
+            groups.append([css])
+        else:
+            groups[-1].append(css)
+    return ['\n'.join(group) for group in groups]
+
+def read_zip_text(zip_ref, info):
+    return zip_ref.read(info).decode('utf-8')
 
-def combine_html_from_zip(zip_file_path):
+def classify_zip_entries(zip_ref):
+    # Sort archive members by extension in one pass. The shallowest HTML file
+    # is the main one, so a root-level page wins over iframe documents saved
+    # under Page_files/; ties go to archive order
+    html_info, html_depth = None, None
+    css_files, js_files = [], []
+    for info in zip_ref.infolist():
+        if info.is_dir():
+            continue
+        if info.filename.endswith('.html'):
+            depth = info.filename.count('/')
+            if html_info is None or depth < html_depth:
+                html_info, html_depth = info, depth
+        elif info.filename.endswith('.css'):
+            css_files.append(info)
+        elif info.filename.endswith('.js'):
+            js_files.append(info)
+    return html_info, css_files, js_files
+
+def combine_html_from_zip(zip_file_path, executor):
     logging.info("Processing ZIP file...")
-    # Extract the zip file to a temporary directory
+    # Read entries straight out of the archive instead of extracting to disk
     with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-        extract_path = tempfile.mkdtemp()
-        zip_ref.extractall(extract_path)
-
-    # Find the main HTML file
-    html_file_path = None
-    for root, _, files in os.walk(extract_path):
-        for file in files:
-            if file.endswith('.html'):
-                html_file_path = os.path.join(root, file)
-                break
-        if html_file_path:
-            break
-
-    if not html_file_path:
-        raise FileNotFoundError("No HTML file found in the uploaded ZIP archive.")
-
-    # Parse the HTML file
-    with open(html_file_path, 'r', encoding='utf-8') as file:
-        soup = BeautifulSoup(file, 'html.parser')
-
-    # Inline CSS
-    css_files = [os.path.join(root, file) for root, _, files in os.walk(extract_path) for file in files if file.endswith('.css')]
-    for css_file in css_files:
-        with open(css_file, 'r', encoding='utf-8') as file:
-            css_content = file.read()
-            style_tag = soup.new_tag('style')
-            style_tag.string = css_content
-            soup.head.append(style_tag)
-
-    # Inline JavaScript
-    js_files = [os.path.join(root, file) for root, _, files in os.walk(extract_path) for file in files if file.endswith('.js')]
-    for js_file in js_files:
-        with open(js_file, 'r', encoding='utf-8') as file:
-            js_content = file.read()
-            script_tag = soup.new_tag('script')
-            script_tag.string = js_content
-            soup.body.append(script_tag)
-
-    # Save the modified HTML to a new file
-    combined_html_path = tempfile.mktemp(suffix=".html")
-    with open(combined_html_path, 'w', encoding='utf-8') as file:
-        file.write(str(soup))
+        html_info, css_files, js_files = classify_zip_entries(zip_ref)
+        if html_info is None:
+            raise FileNotFoundError("No HTML file found in the uploaded ZIP archive.")
+
+        # Parse the HTML file
+        soup = BeautifulSoup(zip_ref.read(html_info), 'lxml', from_encoding='utf-8')
+
+        # Read all CSS and JS entries concurrently; map() keeps results in order
+        contents = list(executor.map(partial(read_zip_text, zip_ref), css_files + js_files))
+
+    # Inline CSS in as few <style> tags as @import rules allow
+    for css_content in group_css(contents[:len(css_files)]):
+        style_tag = soup.new_tag('style')
+        style_tag.string = css_content
+        soup.head.append(style_tag)
+
+    # Inline all JavaScript as a single <script> tag; the ';' separator stops
+    # a file without a trailing semicolon from running into the next one.
+    # Note a "use strict" prologue in the first file now applies to them all
+    if js_files:
+        script_tag = soup.new_tag('script')
+        script_tag.string = '\n;\n'.join(contents[len(css_files):])
+        soup.body.append(script_tag)
 
     logging.info("ZIP processing complete.")
-    return combined_html_path
+    return encode_soup(soup)
 
-async def fetch_and_inline(session, url, tag, attr, tag_name):
-    logging.info(f"Fetching {tag_name} from {url}")
+def response_encoding(response):
+    # The declared charset, or UTF-8 when it is missing or not a known codec
+    # (servers do send labels like 'utf8mb4')
     try:
-        async with session.get(url, timeout=HTTP_TIMEOUT) as response:
-            if response.status == 200:
-                content = await response.text()
-                new_tag = soup.new_tag(tag_name)
-                new_tag.string = content
-                tag.replace_with(new_tag)
-                logging.debug(f"Inlined {tag_name} from {url}")
-            else:
+        return codecs.lookup(response.charset or 'utf-8').name
+    except LookupError:
+        return 'utf-8'
+
+def find_assets(soup, base_url):
+    # Yield (tag, tag_name, url) for each stylesheet <link> and external <script>
+    for link in STYLESHEET_SELECTOR.select(soup):
+        yield link, 'style', urljoin(base_url, link['href'])
+    for script in SCRIPT_SELECTOR.select(soup):
+        yield script, 'script', urljoin(base_url, script['src'])
+
+async def fetch_asset(session, semaphore, url, tag_name):
+    async with semaphore:
+        logging.info(f"Fetching {tag_name} from {url}")
+        try:
+            async with session.get(url, timeout=HTTP_TIMEOUT) as response:
+                if response.status == 200:
+                    # Decode with the declared charset (or UTF-8) rather than
+                    # letting text() run charset detection on the body
+                    raw = await response.read()
+                    return raw.decode(response_encoding(response), errors='replace')
                 logging.warning(f"Failed to fetch {tag_name} from {url}: Status {response.status}")
-    except Exception as e:
-        logging.warning(f"Error fetching {tag_name} from {url}: {e}")
+        except Exception as e:
+            logging.warning(f"Error fetching {tag_name} from {url}: {e}")
+        return None
 
 async def fetch_and_combine_url(url):
-    async with aiohttp.ClientSession() as session:
-        response = await session.get(url, timeout=HTTP_TIMEOUT)
+    # The fragment is never sent to the server, so it does not change the page
+    cache_key = urldefrag(url.strip()).url
+    cached = combined_cache.get(cache_key)
+    if cached is not None:
+        logging.info(f"Using cached result for {url}.")
+        return cached
+
+    session = get_http_session()
+    async with session.get(url, timeout=HTTP_TIMEOUT) as response:
         response.raise_for_status()
         html_content = await response.text()
-        soup = BeautifulSoup(html_content, 'html.parser')
 
-        tasks = []
+    # Collect asset URLs from a quick parse that keeps only <link>/<script>
+    # tags, and start fetching them while the full document is parsed
+    strained = BeautifulSoup(html_content, 'lxml', parse_only=ASSET_STRAINER)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+    fetches = {}
+    try:
+        for _, tag_name, asset_url in find_assets(strained, url):
+            if asset_url not in fetches:
+                fetches[asset_url] = asyncio.ensure_future(fetch_asset(session, semaphore, asset_url, tag_name))
 
-        # Inline CSS from <link> tags
-        for link in soup.find_all('link', href=True):
-            href = link['href']
-            if 'stylesheet' in link.get('rel', []):
-                css_url = urljoin(url, href)
-                tasks.append(fetch_and_inline(session, css_url, link, 'href', 'style'))
+        # The full tree is still needed to write out the combined document
+        soup = await asyncio.to_thread(BeautifulSoup, html_content, 'lxml')
 
-        # Inline JavaScript from <script> tags
-        for script in soup.find_all('script', src=True):
-            src = script['src']
-            js_url = urljoin(url, src)
-            tasks.append(fetch_and_inline(session, js_url, script, 'src', 'script'))
+        assets = list(find_assets(soup, url))
+        for _, tag_name, asset_url in assets:
+            if asset_url not in fetches:
+                fetches[asset_url] = asyncio.ensure_future(fetch_asset(session, semaphore, asset_url, tag_name))
 
-        await asyncio.gather(*tasks)
+        # Wait for every download, then inline CSS from <link> tags and JavaScript
+        # from <script> tags in a single pass, so the tree is only mutated here
+        contents = await asyncio.gather(*(fetches[asset_url] for _, _, asset_url in assets))
+    finally:
+        # Don't leave downloads running if the request was cancelled or failed,
+        # or for URLs only the strained parse saw
+        for fetch in fetches.values():
+            fetch.cancel()
 
-        # Save the modified HTML to a new file
-        combined_html_path = tempfile.mktemp(suffix=".html")
-        with open(combined_html_path, 'w', encoding='utf-8') as file:
-            file.write(str(soup))
+    for (tag, tag_name, asset_url), content in zip(assets, contents):
+        if content is not None:
+            new_tag = soup.new_tag(tag_name)
+            new_tag.string = content
+            tag.replace_with(new_tag)
+            logging.debug(f"Inlined {tag_name} from {asset_url}")
 
-    logging.info(f"URL processing complete for {url}.")
-    return combined_html_path
+    combined_html = encode_soup(soup)
+    # Only cache complete results, so a transient asset failure is retried on
+    # the next request; documents bigger than the whole budget are skipped
+    if all(content is not None for content in contents) and len(combined_html) <= COMBINED_CACHE_BYTES:
+        combined_cache[cache_key] = combined_html
 
-@app.route('/', methods=['GET', 'POST'])
-def index():
-    if request.method == 'POST':
-        if 'file' in request.files and request.files['file'].filename != '':
-            # Handle ZIP file upload
-            file = request.files['file']
-            filename = secure_filename(file.filename)
-            zip_file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(zip_file_path)
-
-            try:
-                combined_html_path = combine_html_from_zip(zip_file_path)
-                return send_file(combined_html_path, as_attachment=True, download_name='combined_from_zip.html')
-            except Exception as e:
-                logging.error(f"Error processing ZIP: {e}")
-                return f"An error occurred: {e}"
-
-        elif 'url' in request.form and request.form['url']:
-            # Handle URL input
-            url = request.form['url']
-            try:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                combined_html_path = loop.run_until_complete(fetch_and_combine_url(url))
-                return send_file(combined_html_path, as_attachment=True, download_name='combined_from_url.html')
-            except Exception as e:
-                logging.error(f"Error processing URL: {e}")
-                return f"An error occurred: {e}"
+    logging.info(f"URL processing complete for {url}.")
+    return combined_html
 
-    # Enhanced HTML form for file upload with CSS styling
-    html_form = '''
+# Static HTML form for file upload with CSS styling; it has no template
+# variables, so it is built once and returned as-is on every GET
+FORM_HTML = '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -227,8 +323,51 @@ def index():
         </div>
     </body>
     </html>
-    '''
-    return render_template_string(html_form)
+'''
+FORM_HTML_GZ = gzip.compress(FORM_HTML.encode('utf-8'), compresslevel=9)
+
+def html_attachment(data, filename):
+    # Send the combined document straight from memory as a download
+    return Response(data, mimetype='text/html', headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/', methods=['GET', 'POST'])
+async def index():
+    if request.method == 'POST':
+        files = await request.files
+        form = await request.form
+        if 'file' in files and files['file'].filename != '':
+            # Handle ZIP file upload
+            file = files['file']
+            filename = secure_filename(file.filename) or 'upload.zip'
+
+            # Each upload gets its own directory inside the scratch area,
+            # removed as soon as the response is built
+            with tempfile.TemporaryDirectory(dir=app.config['UPLOAD_FOLDER']) as work_dir:
+                zip_file_path = os.path.join(work_dir, filename)
+                await file.save(zip_file_path)
+
+                try:
+                    combined_html = await asyncio.to_thread(combine_html_from_zip, zip_file_path, get_file_read_executor())
+                    return html_attachment(combined_html, 'combined_from_zip.html')
+                except Exception as e:
+                    logging.error(f"Error processing ZIP: {e}")
+                    return f"An error occurred: {e}"
+
+        elif 'url' in form and form['url']:
+            # Handle URL input
+            url = form['url']
+            try:
+                combined_html = await fetch_and_combine_url(url)
+                return html_attachment(combined_html, 'combined_from_url.html')
+            except Exception as e:
+                logging.error(f"Error processing URL: {e}")
+                return f"An error occurred: {e}"
+
+    # Serve the pre-compressed form to clients that accept gzip
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        return Response(FORM_HTML_GZ, mimetype='text/html', headers={'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+    return Response(FORM_HTML, mimetype='text/html', headers={'Vary': 'Accept-Encoding'})
 
+# For production, serve with an ASGI server, e.g. `uvicorn app:app --workers 4`
 if __name__ == '__main__':
     app.run(debug=True)